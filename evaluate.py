@@ -1,12 +1,17 @@
 # !/usr/bin/env python3
 # conding=utf-8
 
-import os
 import sys
 import json
 import logging
+from pathlib import Path
 from mwzeval.metrics import Evaluator
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 if __name__ == "__main__":
     import argparse
@@ -76,11 +81,21 @@ if __name__ == "__main__":
 
     args.norm = not args.do_not_norm
 
-    args.input = os.path.realpath(args.input)
-    args.output = os.path.realpath(args.output)
-    args.golden = os.path.realpath(args.golden)
+    if not args.bleu and not args.success and not args.richness and not args.dst:
+        sys.stderr.write(
+            "error: Missing argument, at least one of -b, -d, -s, and -r must be used!\n"
+        )
+        parser.print_help()
+        sys.exit(1)
+
+    output = Path(args.output)
+    if output.parent != Path("."):
+        output.parent.mkdir(parents=True, exist_ok=True)
 
-    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    args.output = str(output.resolve(strict=False))
+    if args.dst:
+        # the golden file is only read for dst
+        args.golden = str(Path(args.golden).resolve(strict=False))
 
     if not args.log:
         if args.output.endswith(".json"):
@@ -88,13 +103,6 @@ if __name__ == "__main__":
         else:
             args.log = args.output + ".log"
 
-    if not args.bleu and not args.success and not args.richness and not args.dst:
-        sys.stderr.write(
-            "error: Missing argument, at least one of -b, -d, -s, and -r must be used!\n"
-        )
-        parser.print_help()
-        sys.exit(1)
-
     logging.root.setLevel(logging.INFO)
     logging.basicConfig(
         filename=args.log,
@@ -106,8 +114,8 @@ if __name__ == "__main__":
     print("- Log file", args.log)
     logger.info("Arguments: %s", args)
 
-    with open(args.input, "r", encoding="utf-8") as f:
-        input_data = json.load(f)
+    with open(args.input, "rb") as f:
+        input_data = orjson.loads(f.read()) if orjson is not None else json.load(f)
 
     e = Evaluator(
         args.bleu,
@@ -127,7 +135,11 @@ if __name__ == "__main__":
     print("=" * 24)
 
     results["args"] = args.__dict__
-    with open(args.output, "w+", encoding="utf-8") as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
+    if orjson is not None:
+        with open(args.output, "wb") as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    else:
+        with open(args.output, "w+", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
 
     print("- Results saved to", args.output)
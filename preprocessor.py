@@ -8,9 +8,21 @@ Removes non-matching keys, or maps to closest ones specific to the dataset.
 
 import argparse
 import json
+import os
 import sys
-import Levenshtein
-from copy import deepcopy
+from contextlib import contextmanager, nullcontext
+from itertools import chain
+from rapidfuzz import process, fuzz
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 # Schemas for MultiWOZ and SpokenWoz
 
@@ -56,84 +68,163 @@ SP_WOZ = {
 }
 
 
-def preprocess_schema(data, schema, verbose=False):
-    """Preprocesses the schema to remove any slot that isn't part of the schema"""
+def load_json(fpr):
+    """Loads json from a binary file object, using orjson when it is available"""
 
-    new_data = {}
-    flag = True
+    if orjson is not None:
+        return orjson.loads(fpr.read())
+    return json.load(fpr)
 
-    for dialog_id, turn_list in data.items():
-        if verbose:
-            print("\rProcessing", dialog_id, end=" ")
-        new_data[dialog_id] = []  # deepcopy(turn_list)
 
-        for i, turn_dict in enumerate(turn_list):
-            new_turn_dict = deepcopy(turn_dict)
-            new_data[dialog_id].append(new_turn_dict)
+def _dumps(data):
+    """Serializes json with 2 space indentation to bytes, using orjson when it is available"""
+
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+@contextmanager
+def atomic_output(out_json):
+    """Yields a file object that replaces out_json only on success, or stdout when out_json is not given"""
+
+    if not out_json:
+        yield sys.stdout.buffer
+        return
+
+    tmp_json = f"{out_json}.{os.getpid()}.tmp"
+    # opened outside the cleanup below, a stale file of another run is never removed
+    fpw = open(tmp_json, "xb")
+    try:
+        with fpw:
+            yield fpw
+        os.replace(tmp_json, out_json)
+    except BaseException:
+        os.remove(tmp_json)
+        raise
+
+
+def iter_dialogs(fpr):
+    """Yields (dialog_id, turn_list) pairs from a binary json file object, lazily when ijson is available"""
+
+    if ijson is not None:
+        events = ijson.parse(fpr, use_float=True)
+        first_event = next(events, None)
+        if first_event is None or first_event[1] != "start_map":
+            raise ValueError("Input json must be an object mapping dialog ids to turn lists")
+        yield from ijson.kvitems(chain([first_event], events), "")
+    else:
+        data = load_json(fpr)
+        if not isinstance(data, dict):
+            raise ValueError("Input json must be an object mapping dialog ids to turn lists")
+        yield from data.items()
+
+
+def dump_dialogs(dialogs, fpw):
+    """Dumps (dialog_id, turn_list) pairs one dialog at a time, identical to _dumps on the corresponding dict"""
+
+    fpw.write(b"{")
+    sep = b"\n  "
+    for dialog_id, turn_list in dialogs:
+        # json strings never contain raw newlines, so re-indenting the fragment is safe
+        fpw.write(sep + _dumps(dialog_id) + b": " + _dumps(turn_list).replace(b"\n", b"\n  "))
+        sep = b",\n  "
+    fpw.write(b"}" if sep == b"\n  " else b"\n}")
+
+
+def compile_schema(schema):
+    """Returns per-domain frozensets for membership tests and tuples for fuzzy matching slot keys"""
+
+    schema_sets = {domain: frozenset(slots) for domain, slots in schema.items()}
+    schema_lists = {domain: tuple(slots) for domain, slots in schema.items()}
+    return schema_sets, schema_lists
 
+
+def preprocess_dialog(turn_list, schema_sets, schema_lists, verbose=False):
+    """Preprocesses the turns of a single dialog with a schema from compile_schema, see preprocess_schema"""
+
+    new_turn_list = []
+
+    for i, turn_dict in enumerate(turn_list):
+        if verbose:
             for act_dom in turn_dict["active_domains"]:
-                if act_dom not in schema:
-                    # do not keep any active domain that isn't part of the  schema
-                    if verbose:
-                        print(f"\n{i} {act_dom} not found in active_domain schema. Removing.")
-                    new_data[dialog_id][i]["active_domains"].remove(act_dom)
+                if act_dom not in schema_sets:
+                    print(f"\n{i} {act_dom} not found in active_domain schema. Removing.")
+
+        # only the active domains and the domain states get modified, rebuild just those
+        new_turn_dict = dict(turn_dict)
+        # do not keep any active domain that isn't part of the  schema
+        new_turn_dict["active_domains"] = [
+            act_dom for act_dom in turn_dict["active_domains"] if act_dom in schema_sets
+        ]
+        new_turn_dict["state"] = state = {}
+        new_turn_list.append(new_turn_dict)
+
+        for domain, domain_dict in turn_dict["state"].items():
+            if domain not in schema_sets:
+                if verbose:
+                    print(f"{i} {domain} not found in schema. Removing.")
+                continue
 
-            if len(turn_dict["state"]) == 0:
+            if isinstance(domain_dict, str):
+                if verbose:
+                    print(f"{i} {domain}:: {domain_dict} is string. Removing.")
                 continue
 
-            for domain, domain_dict in turn_dict["state"].items():
-                if domain not in schema:
+            # keep the known slots in one pass, unknown slots are renamed afterwards or left out
+            slots = schema_sets[domain]
+            domain_d = {slot_key: slot_val for slot_key, slot_val in domain_dict.items() if slot_key in slots}
+            to_rename = []
+            for slot_key, slot_val in domain_dict.items():
+                if slot_key not in slots:
                     if verbose:
-                        print(f"{i} {domain} not found in schema. Removing.")
-                    new_data[dialog_id][i]["state"].pop(domain)
-                    continue
+                        print(f"{i} {domain}:: {slot_key}:{slot_val}")
+
+                    # Find closest slot key
+                    match = process.extractOne(
+                        slot_key, schema_lists[domain], scorer=fuzz.ratio, score_cutoff=70
+                    )
+                    if match is not None:
+                        gt_slot_key = match[0]
+                        if verbose:
+                            print(f"  {slot_key} --> {gt_slot_key}")
+                        to_rename.append((gt_slot_key, slot_val))
+                    elif verbose:
+                        print(f"  Deleting {slot_key}")
 
-                if isinstance(domain_dict, str):
-                    if verbose:
-                        print(f"{i} {domain}:: {domain_dict} is string. Removing.")
-                    new_data[dialog_id][i]["state"].pop(domain)
-                    continue
+            for gt_slot_key, slot_val in to_rename:
+                domain_d[gt_slot_key] = slot_val
+            state[domain] = domain_d
 
-                for slot_key, slot_val in domain_dict.items():
-                    if slot_key not in schema[domain]:
-                        flag = False
-                        if verbose:
-                            print(f"{i} {domain}:: {slot_key}:{slot_val}")
+    return new_turn_list
 
-                        # Find closest slot key
-                        for gt_slot_key in schema[domain]:
-                            if Levenshtein.seqratio(slot_key, gt_slot_key) > 0.7:
-                                if verbose:
-                                    print(f"  {slot_key} --> {gt_slot_key}")
 
-                                new_data[dialog_id][i]["state"][domain][gt_slot_key] = new_data[dialog_id][i][
-                                    "state"
-                                ][domain].pop(slot_key)
-                                flag = True
-                                break
+def iter_preprocess_schema(dialogs, schema, verbose=False):
+    """Lazily preprocesses (dialog_id, turn_list) pairs one dialog at a time, see preprocess_schema"""
 
-                        if not flag:
-                            if verbose:
-                                print(f"  Deleting {slot_key}")
-                            del new_data[dialog_id][i]["state"][domain][slot_key]
+    schema_sets, schema_lists = compile_schema(schema)
 
-    return new_data
+    for dialog_id, turn_list in dialogs:
+        if verbose:
+            print("\rProcessing", dialog_id, end=" ")
+        yield dialog_id, preprocess_dialog(turn_list, schema_sets, schema_lists, verbose)
 
 
-def main(args):
-    """main method"""
+def preprocess_schema(data, schema, verbose=False):
+    """Preprocesses the schema to remove any slot that isn't part of the schema"""
 
-    if len(sys.argv) > 2:
-        data = {}
-        with open(args.in_json, "r", encoding="utf-8") as f:
-            data = json.load(f)
+    return dict(iter_preprocess_schema(data.items(), schema, verbose))
 
-    else:
-        data = json.load(sys.stdin)
+
+def main(args):
+    """main method"""
 
     SCHEMA = SA_MWOZ if args.sa else SP_WOZ
 
-    new_data = preprocess_schema(data, SCHEMA, args.verbose)
+    with (
+        open(args.in_json, "rb") if len(sys.argv) > 2 else nullcontext(sys.stdin.buffer)
+    ) as fpr, atomic_output(args.out_json) as fpw:
+        dump_dialogs(iter_preprocess_schema(iter_dialogs(fpr), SCHEMA, args.verbose), fpw)
 
     # flag = True
 
@@ -192,12 +283,6 @@ def main(args):
     if args.verbose:
         print()
 
-    if args.out_json:
-        with open(args.out_json, "w", encoding="utf-8") as f:
-            json.dump(new_data, f, indent=4)
-    else:
-        json.dump(new_data, sys.stdout, indent=4)
-
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -13,15 +13,25 @@ Custom ontology paths can be provided via --sa-ontology or --sp-ontology argumen
 """
 
 import argparse
+import gc
 import sys
 import json
 import os
 from time import time
-from fuzzywuzzy import process
-from copy import deepcopy
-from functools import partial
+from contextlib import nullcontext
+import numpy as np
+from rapidfuzz import process, fuzz, utils
 from multiprocessing import Pool
-from preprocessor import preprocess_schema, SA_MWOZ, SP_WOZ
+from preprocessor import (
+    atomic_output,
+    compile_schema,
+    preprocess_dialog,
+    iter_dialogs,
+    dump_dialogs,
+    load_json,
+    SA_MWOZ,
+    SP_WOZ,
+)
 
 
 # Default paths - use packaged data files
@@ -33,13 +43,28 @@ DEFAULT_SP_DB = os.path.join(
     _MWZEVAL_DIR, "data", "database", "spoken_woz_ontology.json"
 )
 
+# Candidate names per domain and slot, set once in every worker by _init_worker from _index_names
+_DOMAIN2NAMES = {}
+# Same candidate names as frozensets, to skip the fuzzy matching of exact names
+_DOMAIN2NAME_SETS = {}
+# Same candidate names processed with utils.default_process, in the same order as _DOMAIN2NAMES
+_DOMAIN2NORM_NAMES = {}
+# Closest name per (domain, slot_key, normalized slot_val), filled lazily in every worker
+_CLOSEST_NAMES = {}
+# Output of compile_schema for the dataset, set once in every worker by _init_worker
+_SCHEMA_INDEX = ({}, {})
+# Number of threads used by rapidfuzz.process.cdist in every worker
+_CDIST_WORKERS = 1
+# Print the schema fixes done in every worker
+_VERBOSE = False
+
 
 def load_spokenwoz_domain2names(fname):
     """Load the ontology from the SpokenWoz dataset and convert to domain2 names nested dictionary"""
 
     ontology = {}
-    with open(fname, "r", encoding="utf-8") as fpr:
-        ontology = json.load(fpr)
+    with open(fname, "rb") as fpr:
+        ontology = load_json(fpr)
 
     domain2names = {}
     for dom_slot, names in ontology.items():
@@ -47,80 +72,165 @@ def load_spokenwoz_domain2names(fname):
         if domain not in domain2names:
             domain2names[domain] = {}
         if slot not in ("time", "leaveat", "arriveby", "people", "stars"):
-            domain2names[domain][slot] = names
+            domain2names[domain][slot] = tuple(names)
     return domain2names
 
 
 def load_sa_mwoz_domain2names(fname):
     """Load domain to slot names from the database json file"""
     domain2names = {}
-    with open(fname, "r", encoding="utf-8") as fpr:
-        domain2names = json.load(fpr)
-    return domain2names
+    with open(fname, "rb") as fpr:
+        domain2names = load_json(fpr)
+    return {
+        domain: {slot: tuple(names) for slot, names in slot2names.items()}
+        for domain, slot2names in domain2names.items()
+    }
+
 
+def _index_names(domain2names: dict):
+    """Builds the worker lookup structures once in the main process, inherited by forked workers"""
 
-def fuzzy_map_per_dialog(dialog_dict, domain2names: dict):
+    domain2name_sets = {
+        domain: {slot: frozenset(names) for slot, names in slot2names.items()}
+        for domain, slot2names in domain2names.items()
+    }
+    domain2norm_names = {
+        domain: {
+            slot: tuple(utils.default_process(name) for name in names)
+            for slot, names in slot2names.items()
+        }
+        for domain, slot2names in domain2names.items()
+    }
+    return domain2names, domain2name_sets, domain2norm_names
+
+
+def _init_worker(
+    name_index: tuple,
+    schema_index: tuple,
+    cdist_workers: int = 1,
+    verbose: bool = False,
+):
+    """Stores the outputs of _index_names and compile_schema in the current process, used as the Pool initializer"""
+
+    global _DOMAIN2NAMES, _DOMAIN2NAME_SETS, _DOMAIN2NORM_NAMES
+    global _SCHEMA_INDEX, _CDIST_WORKERS, _VERBOSE
+    _DOMAIN2NAMES, _DOMAIN2NAME_SETS, _DOMAIN2NORM_NAMES = name_index
+    _SCHEMA_INDEX = schema_index
+    _CDIST_WORKERS = cdist_workers
+    _VERBOSE = verbose
+    _CLOSEST_NAMES.clear()
+
+
+def _closest_names(domain, slot_key, slot_vals):
+    """Returns the closest database name for each slot value, scoring only uncached values with one cdist call"""
+
+    choices = _DOMAIN2NAMES[domain][slot_key]
+    norm_choices = _DOMAIN2NORM_NAMES[domain][slot_key]
+    norm_vals = [utils.default_process(slot_val) for slot_val in slot_vals]
+    misses = [
+        norm_val
+        for norm_val in dict.fromkeys(norm_vals)
+        if (domain, slot_key, norm_val) not in _CLOSEST_NAMES
+    ]
+    if misses:
+        # inputs are already canonical, the plain ratio is enough
+        # uint8 scores keep the matrix small and contiguous for the row-wise argmax
+        scores = process.cdist(
+            misses,
+            norm_choices,
+            scorer=fuzz.ratio,
+            processor=None,
+            dtype=np.uint8,
+            workers=_CDIST_WORKERS,
+        )
+        for norm_val, best in zip(misses, scores.argmax(axis=1)):
+            # map the index back to the original-cased name
+            _CLOSEST_NAMES[(domain, slot_key, norm_val)] = choices[best]
+
+    return [_CLOSEST_NAMES[(domain, slot_key, norm_val)] for norm_val in norm_vals]
+
+
+def fuzzy_map_per_dialog(dialog_dict):
     """Fuzzy maps the slot values to the closest one from the database of names"""
 
     new_dialog_dict = {"dialog_id": dialog_dict["dialog_id"], "turn_list": []}
     new_turn_list = []
+    # (domain, slot_key) -> [(turn index, slot value), ...] across the whole dialog
+    queries_by_group = {}
 
     for i, turn_dict in enumerate(dialog_dict["turn_list"]):
-        new_turn_dict = deepcopy(turn_dict)
+        new_turn_dict = dict(turn_dict)
         new_turn_list.append(new_turn_dict)
 
         if turn_dict["state"] is None:
             continue  # Skip this turn if state is None
 
+        # only the slot values get modified, copy just the domain states
+        new_turn_dict["state"] = {
+            domain: dict(domain_dict) if isinstance(domain_dict, dict) else domain_dict
+            for domain, domain_dict in turn_dict["state"].items()
+        }
+
         for domain, domain_dict in turn_dict["state"].items():
             if domain_dict is None:
                 continue  # Skip this domain if domain_dict is None
 
-            for slot_key, slot_val in list(domain_dict.items()):
-                if domain in domain2names and slot_key not in (
+            for slot_key, slot_val in domain_dict.items():
+                if domain in _DOMAIN2NAMES and slot_key not in (
                     "time",
                     "leaveat",
                     "arriveby",
                     "people",
                     "stars",
                 ):
-                    # Find closest slot name using fuzzy matching
-                    try:
-                        closest_name, _ = process.extractOne(
-                            slot_val, domain2names[domain][slot_key]
-                        )  # type: ignore
-                    except TypeError:
+                    if not isinstance(slot_val, str):
                         raise TypeError(
                             f"Error in domain2names[{domain}][{slot_key}] - {domain}: "
                             + json.dumps(slot_val)
                         )
-                    # if args.verbose:
-                    #    print(f"{i} {domain}:: {slot_key}:{slot_val} -> {closest_name}")
-
-                    new_turn_list[i]["state"][domain][slot_key] = closest_name
+                    if slot_val in _DOMAIN2NAME_SETS[domain][slot_key]:
+                        continue  # Already a name from the database
+                    queries_by_group.setdefault((domain, slot_key), []).append(
+                        (i, slot_val)
+                    )
+
+    # Find closest slot names using fuzzy matching, one batch per domain and slot
+    for (domain, slot_key), items in queries_by_group.items():
+        closest_names = _closest_names(
+            domain, slot_key, [slot_val for _, slot_val in items]
+        )
+        for (i, _), closest_name in zip(items, closest_names):
+            # if args.verbose:
+            #    print(f"{i} {domain}:: {slot_key} -> {closest_name}")
+            new_turn_list[i]["state"][domain][slot_key] = closest_name
 
     new_dialog_dict["turn_list"] = new_turn_list
     return new_dialog_dict
 
 
+def preprocess_and_fuzzy_map_per_dialog(dialog_dict):
+    """Fixes the schema of a raw dialog and fuzzy maps its slot values, both in the worker"""
+
+    if _VERBOSE:
+        print("\rProcessing", dialog_dict["dialog_id"], end=" ")
+    turn_list = preprocess_dialog(dialog_dict["turn_list"], *_SCHEMA_INDEX, _VERBOSE)
+    return fuzzy_map_per_dialog(
+        {"dialog_id": dialog_dict["dialog_id"], "turn_list": turn_list}
+    )
+
+
 def main(args):
     """main method"""
 
     # if args.verbose:
     stime = time()
 
-    if len(sys.argv) > 2:
-        data = {}
-        with open(args.in_json, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-    else:
+    if len(sys.argv) <= 2:
         args.verbose = False  # we dont want to print verbose info to stdout
-        data = json.load(sys.stdin)
 
     if args.sa:
         # Speech aware MultiWOZ
-        data = preprocess_schema(data, SA_MWOZ, args.verbose)
+        schema = SA_MWOZ
         sa_db_path = args.sa_ontology if args.sa_ontology else DEFAULT_SA_DB
         if not os.path.exists(sa_db_path):
             raise FileNotFoundError(f"SA-MultiWOZ ontology not found: {sa_db_path}")
@@ -128,41 +238,67 @@ def main(args):
 
     if args.sp:
         # Spoken WOZ
-        data = preprocess_schema(data, SP_WOZ, args.verbose)
+        schema = SP_WOZ
         sp_db_path = args.sp_ontology if args.sp_ontology else DEFAULT_SP_DB
         if not os.path.exists(sp_db_path):
             raise FileNotFoundError(f"SpokenWOZ ontology not found: {sp_db_path}")
         domain2names = load_spokenwoz_domain2names(sp_db_path)
 
     if args.verbose:
-        print("\nDone fixing schema. Now fuzzy mapping slot values.")
+        print("Fixing schema and fuzzy mapping slot values.")
 
-    # convert dialog dict to list of dialog dicts for parallel processing
-    dialog_list = [
-        {"dialog_id": dialog_id, "turn_list": turn_list}
-        for dialog_id, turn_list in data.items()
-    ]
-    fuzzy_map_per_dialog_partial = partial(
-        fuzzy_map_per_dialog, domain2names=domain2names
-    )
+    # let cdist use all cores only when it does not compete with the pool workers
+    cdist_workers = -1 if args.nj == 1 else 1
 
-    with Pool(args.nj) as p:
-        new_dialog_list = p.map(fuzzy_map_per_dialog_partial, dialog_list)
-
-    # convert list of dialog dicts back to dialog dict
-    new_data = {
-        dialog_dict["dialog_id"]: dialog_dict["turn_list"]
-        for dialog_dict in new_dialog_list
-    }
+    initargs = (
+        _index_names(domain2names),
+        compile_schema(schema),
+        cdist_workers,
+        args.verbose,
+    )
 
-    if args.out_json:
-        with open(args.out_json, "w", encoding="utf-8") as f:
-            json.dump(new_data, f, indent=4)
-        if args.verbose:
-            print(args.out_json, "saved.")
-            print("Time taken:", time() - stime)
+    if args.nj == 1:
+        # map in this process, domain2names never has to be sent to a worker
+        _init_worker(*initargs)
+        pool = nullcontext()
     else:
-        json.dump(new_data, sys.stdout, indent=4)
+        # every worker receives domain2names once through the initializer, not with every task.
+        # With fork the workers inherit it copy-on-write. Freezing stops the cyclic garbage
+        # collector from writing to the gc headers of these objects, which reduces the pages
+        # copied per worker. Reference count updates during matching still copy some pages.
+        gc.freeze()
+        pool = Pool(args.nj, initializer=_init_worker, initargs=initargs)
+
+    # the pool comes first so that it is shut down when opening the files fails
+    with pool as p, (
+        open(args.in_json, "rb") if len(sys.argv) > 2 else nullcontext(sys.stdin.buffer)
+    ) as fpr, atomic_output(args.out_json) as fpw:
+        # dialogs are parsed lazily while the workers fix the schema and fuzzy map the previous ones
+        dialog_list = (
+            {"dialog_id": dialog_id, "turn_list": turn_list}
+            for dialog_id, turn_list in iter_dialogs(fpr)
+        )
+        if p is None:
+            new_dialog_list = map(preprocess_and_fuzzy_map_per_dialog, dialog_list)
+        else:
+            # results come back as soon as a chunk is done, dump_dialogs does not depend on the order
+            new_dialog_list = p.imap_unordered(
+                preprocess_and_fuzzy_map_per_dialog,
+                dialog_list,
+                chunksize=args.chunksize,
+            )
+
+        dump_dialogs(
+            (
+                (dialog_dict["dialog_id"], dialog_dict["turn_list"])
+                for dialog_dict in new_dialog_list
+            ),
+            fpw,
+        )
+
+    if args.verbose and args.out_json:
+        print("\n" + args.out_json, "saved.")
+        print("Time taken:", time() - stime)
 
 
 if __name__ == "__main__":
@@ -202,6 +338,12 @@ if __name__ == "__main__":
         required=False,
     )
     parser.add_argument("--nj", type=int, default=4, help="Number of parallel jobs")
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=16,
+        help="Number of dialogs sent to a parallel job at once",
+    )
     parser.add_argument(
         "--verbose",
         action="store_true",